@@ -1,7 +1,14 @@
 from dotenv import load_dotenv
 from openai import OpenAI
+import contextvars
 import json
 import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
 from pypdf import PdfReader
 import gradio as gr
@@ -19,6 +26,180 @@ elif os.path.exists(root_env):
 else:
     print("⚠️ No local .env found, relying on Hugging Face environment variables.")
 
+# --- Observability (spans + Prometheus metrics) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """Minimal thread-safe counters/histograms rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    def inc(self, name, value=1, help="", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help.setdefault(name, ("counter", help))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, help="", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help.setdefault(name, ("histogram", help))
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def render(self):
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for name, (kind, help) in sorted(self.help.items()):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for (n, labels), value in sorted(self.counters.items()):
+                        if n == name:
+                            lines.append(f"{name}{fmt(labels)} {value}")
+                    continue
+                for (n, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {bucket}")
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{fmt(labels)} {total}")
+                    lines.append(f"{name}_count{fmt(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+current_span = contextvars.ContextVar("current_span", default=None)
+TRACE_SPANS = os.getenv("TRACE_SPANS") == "1"
+
+@contextmanager
+def span(name, **attributes):
+    """OpenTelemetry-style span: times the block and nests under the current span"""
+    parent = current_span.get()
+    record = {
+        "name": name,
+        "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "attributes": attributes,
+    }
+    token = current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = repr(e)
+        metrics.inc(
+            "cv_chat_errors_total", help="Exceptions raised inside a span",
+            span=name, **attributes,
+        )
+        raise
+    finally:
+        current_span.reset(token)
+        record["duration"] = time.perf_counter() - start
+        metrics.observe(
+            "cv_chat_span_duration_seconds", record["duration"],
+            help="Duration of chat turn spans", span=name, **attributes,
+        )
+        if TRACE_SPANS:
+            print(f"🧭 Span: {json.dumps(record, default=str)}")
+
+def record_usage(provider, response):
+    """Count tokens, prompt cache hits and prompt processing time from a provider response.
+
+    Ollama only reports the prompt tokens it had to evaluate (cached ones are
+    skipped), so they are counted as kind="prompt_eval" rather than "prompt",
+    and it has no cached-token count. Its cache hit is a flag set by
+    OllamaClient instead.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    if hasattr(usage, "model_dump"):
+        usage = usage.model_dump()
+    for kind in ("prompt", "prompt_eval", "completion"):
+        if usage.get(f"{kind}_tokens") is not None:
+            metrics.inc(
+                "cv_chat_tokens_total", usage[f"{kind}_tokens"],
+                help="Tokens used per provider", provider=provider, kind=kind,
+            )
+    # DeepSeek reports prompt_cache_hit_tokens, OpenAI prompt_tokens_details.cached_tokens
+    cached = usage.get("prompt_cache_hit_tokens") or (
+        (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    )
+    if cached:
+        metrics.inc(
+            "cv_chat_tokens_total", cached,
+            help="Tokens used per provider", provider=provider, kind="cached",
+        )
+    if usage.get("prompt_eval_seconds") is not None:
+        metrics.observe(
+            "cv_chat_prompt_eval_seconds", usage["prompt_eval_seconds"],
+            help="Time the provider spent processing the prompt", provider=provider,
+        )
+    if cached or usage.get("prompt_cache_hit"):
+        metrics.inc(
+            "cv_chat_prompt_cache_hits_total",
+            help="Provider calls that reused a cached prompt prefix", provider=provider,
+        )
+
+PAYLOAD_LOG_RATE = float(os.getenv("PAYLOAD_LOG_RATE") or "0.01")
+PAYLOAD_LOG_CHARS = int(os.getenv("PAYLOAD_LOG_CHARS") or "500")
+
+def log_payload(label, payload):
+    """Log a sampled, truncated payload instead of dumping the full CV every call"""
+    if random.random() >= PAYLOAD_LOG_RATE:
+        return
+    text = str(payload)
+    if len(text) > PAYLOAD_LOG_CHARS:
+        text = f"{text[:PAYLOAD_LOG_CHARS]}... ({len(text)} chars)"
+    print(f"🔍 {label}: {text}")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port=None):
+    port = int(port or os.getenv("METRICS_PORT") or "9464")
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    except OSError as e:
+        print(f"⚠️ Metrics endpoint unavailable on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 Metrics on http://127.0.0.1:{port}/metrics")
+    return server
+
 # --- Pushover helper ---
 def push(text):
     token = os.getenv("PUSHOVER_TOKEN")
@@ -26,10 +207,11 @@ def push(text):
     if not token or not user:
         print("⚠️ Pushover credentials missing, skipping push:", text)
         return
-    requests.post(
-        "https://api.pushover.net/1/messages.json",
-        data={"token": token, "user": user, "message": text},
-    )
+    with span("push"):
+        requests.post(
+            "https://api.pushover.net/1/messages.json",
+            data={"token": token, "user": user, "message": text},
+        )
 
 # --- Tool functions ---
 def record_user_details(email, name, notes=""):
@@ -81,6 +263,9 @@ tools = [
     {"type": "function", "function": record_unknown_question_json},
 ]
 
+# Stop a model that keeps calling tools from looping (and re-sending pushes) forever
+MAX_TOOL_ROUNDS = 3
+
 # --- DeepSeek Integration ---
 class DeepSeekClient:
     def __init__(self, api_key=None):
@@ -110,11 +295,11 @@ class DeepSeekClient:
             "temperature": 0.7
         }
         
-        print(f"🔍 DeepSeek Request: {data}")
+        log_payload("DeepSeek Request", data)
         response = requests.post(self.base_url, headers=headers, json=data)
         
         if response.status_code != 200:
-            print(f"❌ DeepSeek Error {response.status_code}: {response.text}")
+            print(f"❌ DeepSeek Error {response.status_code}: {response.text[:PAYLOAD_LOG_CHARS]}")
             response.raise_for_status()
         
         result = response.json()
@@ -127,6 +312,7 @@ class DeepSeekClient:
                     self.choices = [Choice(choice)]
                 else:
                     self.choices = []
+                self.usage = result_data.get('usage')
         
         class Choice:
             class Message:
@@ -154,70 +340,175 @@ class DeepSeekClient:
 # --- Ollama Integration (Local, Free) ---
 class OllamaClient:
     def __init__(self):
-        self.base_url = "http://localhost:11434/api"
-        self.model = "llama3"
-        
+        # OLLAMA_HOST is often set without a scheme (e.g. localhost:11434)
+        host = os.getenv("OLLAMA_HOST") or "localhost:11434"
+        if "://" not in host:
+            host = f"http://{host}"
+        self.base_url = host.rstrip("/") + "/api"
+        self.model = os.getenv("OLLAMA_MODEL") or "llama3"
+        # Keep the model (and its cached system prompt) loaded between turns
+        self.keep_alive = os.getenv("OLLAMA_KEEP_ALIVE") or "30m"
+        # Cap in-flight requests at the number of parallel slots Ollama serves
+        self.slots = threading.BoundedSemaphore(int(os.getenv("OLLAMA_NUM_PARALLEL") or "4"))
+        # Prompt tokens of the warmed-up system prefix, used to spot cache hits
+        self.prefix_tokens = None
+
         # Create a chat.completions.create method that matches OpenAI
         chat = type('Chat', (), {
             'completions': type('Completions', (), {
                 'create': self._make_request
             })()
         })()
-        
+
         self.chat = chat
-    
+
     def test_connection(self):
         """Test if Ollama is running"""
-        response = requests.get(f"{self.base_url}/tags")
+        response = requests.get(f"{self.base_url}/tags", timeout=5)
         if response.status_code != 200:
             raise Exception("Ollama not running. Install with: brew install ollama && ollama run llama3")
-    
+
+    def warm_up(self, system_prompt, tools=None):
+        """Load the model and prefill the system prompt before the first turn"""
+        result = self._post_chat({
+            "model": self.model,
+            # Same conversion as real turns, so the cached prefix matches
+            "messages": self._to_ollama_messages(
+                [{"role": "system", "content": system_prompt}], tools
+            ),
+            "stream": False,
+            "keep_alive": self.keep_alive,
+            "options": {"num_predict": 1},
+        }, timeout=600)  # first load processes the whole CV
+        self.prefix_tokens = result.get('prompt_eval_count')
+
+    def _post_chat(self, data, timeout=120):
+        with self.slots:
+            response = requests.post(f"{self.base_url}/chat", json=data, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
     def _make_request(self, model=None, messages=None, tools=None, **kwargs):
-        # Convert OpenAI format to Ollama format
-        prompt = self._messages_to_prompt(messages)
-        
         data = {
             "model": self.model,
-            "prompt": prompt,
-            "stream": False
+            "messages": self._to_ollama_messages(messages, tools),
+            "stream": False,
+            "keep_alive": self.keep_alive,
         }
-        
-        response = requests.post(f"{self.base_url}/generate", json=data)
-        response.raise_for_status()
-        
-        result = response.json()
-        
+
+        result = self._post_chat(data)
+        content = result.get('message', {}).get('content', '')
+        tool_calls = self._parse_tool_calls(content, tools)
+
+        evaluated = result.get('prompt_eval_count')
+        usage = {
+            "prompt_eval_tokens": evaluated,
+            "completion_tokens": result.get('eval_count'),
+            "prompt_eval_seconds": (result.get('prompt_eval_duration') or 0) / 1e9,
+            # Fewer tokens evaluated than the system prefix means it came from cache
+            "prompt_cache_hit": bool(
+                self.prefix_tokens and evaluated is not None
+                and evaluated < self.prefix_tokens
+            ),
+        }
+
         # Transform Ollama response to match OpenAI format
         class Response:
             class Choice:
                 class Message:
-                    def __init__(self, content):
-                        self.content = content
-                        self.tool_calls = []  # Ollama doesn't support function calling yet
-                
-                def __init__(self, content):
-                    self.message = Response.Choice.Message(content)
-                    self.finish_reason = "stop"
-            
-            def __init__(self, content):
-                self.choices = [Response.Choice(content)]
-        
-        return Response(result.get('response', ''))
-    
-    def _messages_to_prompt(self, messages):
-        """Convert OpenAI messages format to Ollama prompt"""
-        prompt = ""
+                    def __init__(self, content, tool_calls):
+                        self.role = "assistant"
+                        self.content = None if tool_calls else content
+                        self.raw_content = content
+                        self.tool_calls = tool_calls
+
+                def __init__(self, content, tool_calls):
+                    self.message = Response.Choice.Message(content, tool_calls)
+                    self.finish_reason = "tool_calls" if tool_calls else "stop"
+
+            def __init__(self, content, tool_calls):
+                self.choices = [Response.Choice(content, tool_calls)]
+                self.usage = usage
+
+        return Response(content, tool_calls)
+
+    def _to_ollama_messages(self, messages, tools):
+        """Convert OpenAI messages to Ollama chat messages.
+
+        The system message is kept first and byte-identical across turns, with
+        the tool instructions appended after it, so Ollama can reuse the
+        cached prefix instead of re-processing the CV on every turn.
+        """
+        converted = []
         for msg in messages:
+            if not isinstance(msg, dict):
+                # Assistant message returned by a previous tool-calling round
+                converted.append({"role": "assistant", "content": msg.raw_content})
+                continue
             role = msg['role']
-            content = msg['content']
-            if role == 'system':
-                prompt += f"System: {content}\n\n"
-            elif role == 'user':
-                prompt += f"User: {content}\n"
-            elif role == 'assistant':
-                prompt += f"Assistant: {content}\n"
-        prompt += "Assistant:"
-        return prompt
+            content = msg.get('content') or ""
+            if role == 'system' and tools:
+                content += self._tools_prompt(tools)
+            elif role == 'tool':
+                role, content = 'user', f"Tool result: {content}"
+            converted.append({"role": role, "content": content})
+        return converted
+
+    def _tools_prompt(self, tools):
+        specs = "\n".join(json.dumps(t["function"]) for t in tools)
+        return (
+            "\n\n🛠️ Tools available:\n"
+            f"{specs}\n"
+            "To call a tool, reply with ONLY a JSON object and nothing else:\n"
+            '{"tool": "<tool name>", "arguments": {<arguments>}}'
+        )
+
+    def _parse_tool_calls(self, content, tools):
+        """Extract a prompt-based tool call from the model's reply.
+
+        Only calls to a known tool whose arguments match its schema are
+        accepted; anything else is treated as a plain text reply.
+        """
+        if not tools:
+            return []
+        schemas = {t["function"]["name"]: t["function"]["parameters"] for t in tools}
+        decoder = json.JSONDecoder()
+        start = content.find("{")
+        while start != -1:
+            try:
+                call, _ = decoder.raw_decode(content[start:])
+            except ValueError:
+                call = None
+            arguments = self._check_arguments(call, schemas)
+            if arguments is not None:
+                break
+            start = content.find("{", start + 1)
+        else:
+            return []
+        return [
+            type('ToolCall', (), {
+                'id': f"call_{uuid.uuid4().hex[:8]}",
+                'function': type('Function', (), {
+                    'name': call["tool"],
+                    'arguments': json.dumps(arguments)
+                })()
+            })()
+        ]
+
+    def _check_arguments(self, call, schemas):
+        """Return the call's arguments filtered to the tool schema, or None if invalid"""
+        if not isinstance(call, dict) or call.get("tool") not in schemas:
+            return None
+        arguments = call.get("arguments")
+        if arguments is None:
+            arguments = {}
+        if not isinstance(arguments, dict):
+            return None
+        schema = schemas[call["tool"]]
+        arguments = {k: v for k, v in arguments.items() if k in schema["properties"]}
+        if any(k not in arguments for k in schema.get("required", [])):
+            return None
+        return arguments
 
 # --- Main Chat Class ---
 class Me:
@@ -234,6 +525,12 @@ class Me:
         # Load Summary
         with open("data/summary.txt", "r", encoding="utf-8") as f:
             self.summary = f.read()
+
+        if self.provider == "ollama":
+            try:
+                self.ai_client.warm_up(self.system_prompt(), tools)
+            except Exception as e:
+                print(f"⚠️ Ollama warm-up failed: {e}")
             
     def _init_ai_client(self):
         # Try OpenAI first
@@ -248,6 +545,7 @@ class Me:
                     messages=[{"role": "user", "content": "Hello"}],
                     max_tokens=1
                 )
+                self.provider = "openai"
                 return client
             except Exception as e:
                 print(f"⚠️ OpenAI API failed: {e}")
@@ -259,6 +557,7 @@ class Me:
         deepseek_key = os.getenv("DEEPSEEK_API_KEY")
         if deepseek_key:
             print("✅ Using DeepSeek")
+            self.provider = "deepseek"
             return DeepSeekClient(deepseek_key)
         
         # Final fallback to Ollama (completely free, local)
@@ -267,6 +566,7 @@ class Me:
             ollama_client = OllamaClient()
             ollama_client.test_connection()
             print("✅ Using Ollama (local)")
+            self.provider = "ollama"
             return ollama_client
         except Exception as e:
             print(f"⚠️ Ollama not available: {e}")
@@ -284,7 +584,8 @@ class Me:
             arguments = json.loads(tool_call.function.arguments)
             print(f"⚙️ Tool called: {tool_name}", flush=True)
             tool = globals().get(tool_name)
-            result = tool(**arguments) if tool else {}
+            with span("tool", tool=tool_name):
+                result = tool(**arguments) if tool else {}
             results.append(
                 {"role": "tool", "content": json.dumps(result), "tool_call_id": tool_call.id}
             )
@@ -311,36 +612,40 @@ You are answering questions from recruiters on {self.name}'s website.
         return system_prompt.strip()
 
     def chat(self, message, history):
-        messages = [{"role": "system", "content": self.system_prompt()}] + history + [
-            {"role": "user", "content": message}
-        ]
-        
-        done = False
-        while not done:
-            # Use appropriate model based on client type
-            if isinstance(self.ai_client, OpenAI):
-                response = self.ai_client.chat.completions.create(
-                    model="gpt-4o-mini", messages=messages, tools=tools
-                )
-            elif hasattr(self.ai_client, 'model') and self.ai_client.model == "llama3":
-                # Ollama client - no function calling support yet
-                response = self.ai_client.chat.completions.create(
-                    messages=messages
-                )
-            else:
-                # DeepSeek client already handles model internally
-                response = self.ai_client.chat.completions.create(
-                    messages=messages, tools=tools
-                )
-            if response.choices[0].finish_reason == "tool_calls":
-                message = response.choices[0].message
-                tool_calls = message.tool_calls
-                results = self.handle_tool_call(tool_calls)
-                messages.append(message)
-                messages.extend(results)
-            else:
-                done = True
-        return response.choices[0].message.content
+        with span("chat_turn"):
+            with span("build_prompt"):
+                messages = [{"role": "system", "content": self.system_prompt()}] + history + [
+                    {"role": "user", "content": message}
+                ]
+
+            tool_rounds = 0
+            done = False
+            while not done:
+                with span("provider_call", provider=self.provider):
+                    # Use appropriate model based on client type
+                    if self.provider == "openai":
+                        response = self.ai_client.chat.completions.create(
+                            model="gpt-4o-mini", messages=messages, tools=tools
+                        )
+                    else:
+                        # DeepSeek and Ollama clients handle the model internally
+                        response = self.ai_client.chat.completions.create(
+                            messages=messages, tools=tools
+                        )
+                record_usage(self.provider, response)
+                if response.choices[0].finish_reason == "tool_calls":
+                    if tool_rounds == MAX_TOOL_ROUNDS:
+                        print(f"⚠️ Tool call limit ({MAX_TOOL_ROUNDS}) reached, stopping")
+                        return "Sorry, I couldn't finish that request. Could you rephrase it?"
+                    tool_rounds += 1
+                    message = response.choices[0].message
+                    tool_calls = message.tool_calls
+                    results = self.handle_tool_call(tool_calls)
+                    messages.append(message)
+                    messages.extend(results)
+                else:
+                    done = True
+            return response.choices[0].message.content
 
 # --- Gradio Recruiter Info Form ---
 def recruiter_form(name, email, notes):
@@ -349,6 +654,7 @@ def recruiter_form(name, email, notes):
 
 # --- Launch Gradio app ---
 if __name__ == "__main__":
+    serve_metrics()
     me = Me()
 
     chat = gr.ChatInterface(
@@ -0,0 +1,34 @@
+"""
+Observability Overhead Benchmark for CV Chat
+Measures the per-call cost of the tracing/metrics hooks in app.py
+Run from cv_chat/: python bench_overhead.py
+"""
+
+import time
+
+from app import record_usage, span
+
+N = 100_000
+
+def per_call_us(fn):
+    start = time.perf_counter()
+    for _ in range(N):
+        fn()
+    return (time.perf_counter() - start) / N * 1e6
+
+def empty():
+    pass
+
+def nested_span():
+    with span("bench_turn"):
+        with span("bench_call", provider="bench"):
+            pass
+
+class FakeResponse:
+    usage = {"prompt_tokens": 1200, "completion_tokens": 80, "prompt_cache_hit_tokens": 1024}
+
+if __name__ == "__main__":
+    baseline = per_call_us(empty)
+    print(f"⏱️ Empty call:        {baseline:.2f} µs")
+    print(f"⏱️ Span (2 nested):   {per_call_us(nested_span) - baseline:.2f} µs")
+    print(f"⏱️ record_usage:      {per_call_us(lambda: record_usage('bench', FakeResponse())) - baseline:.2f} µs")